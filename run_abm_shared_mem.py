@@ -13,7 +13,6 @@ import sys
 import csv
 import time
 import math
-import copy
 import random
 import unidecode
 import numpy as np
@@ -21,7 +20,8 @@ import pandas as pd
 import networkx as nx
 import geopandas as gpd
 import matplotlib.pyplot as plt
-from multiprocessing.pool import Pool
+import numba
+from numba import njit, prange
 
 # CONSTANTS
 config = {
@@ -59,8 +59,8 @@ config = {
     # Set number of simulation steps; 1 step = 1 day
     'num_steps':1,
 
-    # Number of chunks (processes) to split refugees into during a sim step
-    # These dont necessarily have to be equal
+    # Number of threads to process refugees on during a sim step
+    # num_batches is kept for older parameter files but no longer used
 
     'num_batches': 16,
     'num_processes': 16,  # mp.cpu_count()
@@ -105,56 +105,6 @@ config = {
 sim = None
 
 
-class Ref(object):
-    """
-    Class representative of a single refugee
-    """
-
-    def __init__(self, node, num_refugees):
-        self.node = node  # Not used. Agent ID == Index in Sim.all_refugees
-        self.kin_list = []
-        self.friend_list = []
-#         self.node_history = []
-
-    def create_defined_social_links(self, index, sim):
-        # create kin
-        for x in range(config['num_kin']):
-            kin = index
-            while kin == index:
-                kin = random.randint(0, sim.num_refugees - 1)
-            self.kin_list.append(kin)
-            # set for other kin
-            sim.all_refugees[kin].kin_list.append(index)
-
-        # create friends
-        for x in range(config['num_friends']):
-            friend = index
-            while friend == index:
-                friend = random.randint(0, sim.num_refugees - 1)
-            self.friend_list.append(friend)
-            # set for other friend
-            sim.all_refugees[friend].friend_list.append(index)
-
-    def create_random_social_links(self, index, sim):
-        # create kin
-        for x in range(random.randint(config['num_kin'][0], config['num_kin'][1])):
-            kin = index
-            while kin == index:
-                kin = random.randint(0, sim.num_refugees - 1)
-            self.kin_list.append(kin)
-            # set for other kin
-            sim.all_refugees[kin].kin_list.append(index)
-
-        # create friends
-        for x in range(random.randint(config['num_friends'][0], config['num_friends'][1])):
-            friend = index
-            while friend == index:
-                friend = random.randint(0, sim.num_refugees - 1)
-            self.friend_list.append(friend)
-            # set for other friend
-            sim.all_refugees[friend].friend_list.append(index)
-
-
 class Sim(object):
     """
     Class representative of the simulation
@@ -165,160 +115,136 @@ class Sim(object):
         self.paths = paths
         self.num_steps = num_steps
         self.num_processes = num_processes
-        self.num_batches = num_batches
-        self.num_refugees = sum([self.graph.nodes[n]['weight'] for n in self.graph.nodes])
-        self.all_refugees = []
-        for node in self.graph.nodes():
-            self.all_refugees.extend([Ref(node, self.num_refugees) for x in range(self.graph.nodes[node]['weight'])])
-
-        if isinstance(config['num_friends'], int):
-            for index, ref in enumerate(self.all_refugees):
-                ref.create_defined_social_links(index, self)
+        # Struct-of-arrays state. Nodes are encoded as contiguous integer ids (index in self.nodes)
+        # so that agent and node state can be held in flat numpy arrays instead of Python objects.
+        # The node attributes are snapshot in a single pass over the graph
+        self.nodes = list(self.graph.nodes)
+        self.node_id = {n: i for i, n in enumerate(self.nodes)}
+        weights, conflicts, camps, locations = zip(*[
+            (d['weight'], d['num_conflicts'], d['num_camps'], d['location_score'])
+            for n, d in self.graph.nodes(data=True)])
+        self.weights_arr = np.array(weights, dtype=np.int64)
+        self.num_conflicts_arr = np.array(conflicts, dtype=np.int32)
+        self.num_camps_arr = np.array(camps, dtype=np.int32)
+        self.location_arr = np.array(locations, dtype=np.float64)
+        self.node_score_arr = np.zeros(len(self.nodes), dtype=np.float64)
+
+        # Refs are identified by their index in the agent arrays (0 .. num_refugees - 1)
+        self.num_refugees = int(self.weights_arr.sum())
+        self.node_of_ref = np.repeat(np.arange(len(self.nodes), dtype=np.int32), self.weights_arr)
+
+        # Symmetric social links as edge arrays (src ref -> dst ref), packed into CSR arrays by update_social_links
+        self.kin_src, self.kin_dst = np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+        self.friend_src, self.friend_dst = np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+        self.create_social_links()
+        self.update_social_links()
+
+        # Move parameters of the process_refs kernel, read from the config once per sim. They are cast to fixed
+        # types so that e.g. a probability of 1 and of 0.7 run the same compiled (and cached) kernel
+        self.move_params = (float(config['camp_move_probability']), float(config['other_move_probability']),
+                            float(config['kin_weight']), float(config['friend_weight']),
+                            int(config['max_kin']), int(config['max_friends']))
+
+        # Static routing table: next_hop[a, b] is the next node on the shortest path from a to b.
+        # Refs stay in place if b can not be reached from a
+        self.next_hop = np.repeat(np.arange(len(self.nodes), dtype=np.int32)[:, None], len(self.nodes), axis=1)
+        for source, targets in self.paths.items():
+            for target, path in targets.items():
+                self.next_hop[self.node_id[source], self.node_id[target]] = self.node_id[path[1]]
+
+    def create_social_links(self, start=0):
+        """
+        Create kin and friends for refs start .. num_refugees - 1, linked to any ref in the sim
+        """
+        refs = np.arange(start, self.num_refugees, dtype=np.int32)
+        self.kin_src, self.kin_dst = self.create_links(refs, config['num_kin'], self.kin_src, self.kin_dst)
+        self.friend_src, self.friend_dst = self.create_links(refs, config['num_friends'],
+                                                             self.friend_src, self.friend_dst)
+
+    def create_links(self, refs, num_links, src, dst):
+        """
+        Draw num_links random links for each of refs and append them in both directions to the src/dst edges.
+        num_links is an int for a defined number of links or a tuple (low, high) for a random number per ref
+        """
+        if isinstance(num_links, int):
+            counts = np.full(len(refs), num_links)
         else:
-            for index, ref in enumerate(self.all_refugees):
-                ref.create_random_social_links(index, self)
-
-    def find_new_node(self, node, ref):
-        global sim
-        
-        kin_nodes = [self.all_refugees[kin].node for kin in ref.kin_list]
-        friend_nodes = [self.all_refugees[friend].node for friend in ref.friend_list]
-
-        # initialize max node value to negative number
-        most_desirable_score = -99
-        most_desirable_neighbor = node
-            
-        for n in self.graph.nodes: 
-            if self.graph.nodes[n]['node_score'] > self.graph.nodes[node]['node_score']:
-                kin_at_node = kin_nodes.count(n)
-                friends_at_node = friend_nodes.count(n)
-                desirability = (max(kin_at_node, config['max_kin']) * config['kin_weight']) + \
-                               (max(friends_at_node, config['max_friends']) * config['friend_weight']) + \
-                               self.graph.nodes[n]['node_score']
-
-                if (desirability > most_desirable_score):
-                    most_desirable_score = desirability
-                    most_desirable_neighbor = n
-        
-        return most_desirable_neighbor
-
-    def process_refs(self, se):
-        global sim
-        refs_moved = 0
-        new_refs = []
-        ref_nodes = {key: [] for key in self.graph.nodes}
-        new_weights = {key: 0 for key in self.graph.nodes}
-
-        for x, ref in enumerate(self.all_refugees[se[0]:se[1]]):
-            node = ref.node
-            num_conflicts = self.graph.nodes[node]['num_conflicts']
-            num_camps = self.graph.nodes[node]['num_camps']
-
-            if num_conflicts > 0:
-                # Conflict zone
-                move = True
-            elif num_camps > 0:
-                # At a camp
-                move = random.random() < config['camp_move_probability']
-            else:
-                # Neither camp nor conflict
-                move = random.random() < config['other_move_probability']
-
-            new_refs.append(copy.deepcopy(ref))
-            if move:  # and node in self.paths.keys()
-                high_node = self.find_new_node(node, ref)
-                new_node = self.paths[node][high_node][1]  # the next node in the list in the direction of most desirable
-                new_refs[x].node = new_node
-                refs_moved += 1
-
-            
-            ref_nodes[new_refs[x].node].append(x + se[0])
-
-        # return new refugee list and node weight updates for these refs
-        return new_refs, ref_nodes, refs_moved
-
+            counts = np.random.randint(num_links[0], num_links[1] + 1, len(refs))
+        link_src = np.repeat(refs, counts)
+        link_dst = np.random.randint(0, self.num_refugees, len(link_src)).astype(np.int32)
+
+        # Redraw links of refs to themselves (usually done after one or two passes)
+        mask = link_dst == link_src
+        while mask.any():
+            link_dst[mask] = np.random.randint(0, self.num_refugees, mask.sum())
+            mask = link_dst == link_src
+
+        return np.concatenate([src, link_src, link_dst]), np.concatenate([dst, link_dst, link_src])
+
+    def update_social_links(self):
+        """
+        Rebuild the kin and friend CSR arrays from the social link edge lists
+        """
+        self.kin_indptr, self.kin_indices = build_csr(self.kin_src, self.kin_dst, self.num_refugees)
+        self.friend_indptr, self.friend_indices = build_csr(self.friend_src, self.friend_dst, self.num_refugees)
+
+    def process_refs(self, rand_buf):
+        # Move refs one step towards their most desirable node
+        new_nodes, refs_moved = process_refs_jit(self.node_of_ref, self.node_score_arr, self.next_hop,
+                                                 self.kin_indptr, self.kin_indices,
+                                                 self.friend_indptr, self.friend_indices, rand_buf,
+                                                 self.num_conflicts_arr, self.num_camps_arr, *self.move_params)
+
+        # Node weight updates, aggregated with bincount in one C pass per side
+        delta = np.bincount(new_nodes, minlength=len(self.nodes)) - \
+                np.bincount(self.node_of_ref, minlength=len(self.nodes))
+
+        # return new nodes of the refs and node weight updates
+        return new_nodes, delta, refs_moved
 
     def step(self):
-        nx.get_node_attributes(self.graph, 'weight')
-        orig_weights = nx.get_node_attributes(self.graph, 'weight')
-
         # Update normalized node weights
-        max_pop = max(orig_weights.values())
-        norm_weights = [x / max_pop for x in orig_weights.values()]
-        norm_weights = dict(zip(orig_weights.keys(), norm_weights))
-        nx.set_node_attributes(self.graph, norm_weights, 'norm_weight')
-
-        # Normalize camps
-        num_camps = nx.get_node_attributes(self.graph, 'num_camps')
-        max_camps = max(list(num_camps.values()) + [1])
-        num_camps = [x / max_camps for x in num_camps.values()]
+        norm_weights = self.weights_arr / self.weights_arr.max()
 
-        # Normalize conflicts
-        num_conflicts = nx.get_node_attributes(self.graph, 'num_conflicts')
-        max_conflict = max(list(num_conflicts.values()) + [1])  # Add a max of 1 to prevent division by zero error
-        num_conflicts = [x / max_conflict for x in num_conflicts.values()]
+        # Normalize camps and conflicts. Add a max of 1 to prevent division by zero error
+        norm_camps = self.num_camps_arr / max(self.num_camps_arr.max(), 1)
+        norm_conflicts = self.num_conflicts_arr / max(self.num_conflicts_arr.max(), 1)
 
         # Update node score
-        location_scores = nx.get_node_attributes(self.graph, 'location_score')
-        node_scores = [
-            (w * config['population_weight']) + (x * config['location_weight']) + (y * config['camp_weight']) + (
-                        z * (-1) * config['conflict_weight']) for
-            w, x, y, z in
-            zip(norm_weights.values(), location_scores.values(), num_camps, num_conflicts)]
-        node_scores = dict(zip(norm_weights.keys(), node_scores))
-        nx.set_node_attributes(self.graph, node_scores, 'node_score')
-
-        # Whether to process in parallel or synchronously
-        if self.num_processes > 1:
-            print(f'Staring {self.num_processes} processes...')
-            # Chunk refs and send to processes
-            bs = len(self.all_refugees) / float(self.num_batches)
-            if bs % 1 != 0:
-                bs = bs+1
-            bs = int(bs)
-            se = [[x, x+bs] for x in range(0, len(self.all_refugees), bs)]
-            se[-1][-1] = len(self.all_refugees)
-
-            pool = Pool(self.num_processes)
-
-            results = pool.map(self.process_refs, se)
-            pool.close()
-            pool.join()
-        else:
-            print('Not Multiprocessing')
-            results = [process_refs((0, len(self.all_refugees)))]
-
-        self.all_refugees = []
-        # new_weights = [orig_weights]
-        ref_nodes = []
-        total_refs_moved = 0
-        for result in results:
-            self.all_refugees.extend(result[0])
-            ref_nodes.append(result[1])
-            total_refs_moved += result[2]
-
-        ref_nodes = pd.DataFrame(ref_nodes)
-        ref_nodes = dict(zip(self.graph.nodes, list(ref_nodes.sum())))
-                
-        new_weights = [len(x) for x in ref_nodes.values()]
-        new_weights = dict(zip(self.graph.nodes, new_weights))
-        nx.set_node_attributes(self.graph, new_weights, 'weight')
+        self.node_score_arr = (norm_weights * config['population_weight']) + \
+                              (self.location_arr * config['location_weight']) + \
+                              (norm_camps * config['camp_weight']) - \
+                              (norm_conflicts * config['conflict_weight'])
+
+        # Process all refs in one numba kernel. Its prange loop runs on the threads set up in run() that share
+        # the sim arrays, so nothing has to be pickled to worker processes.
+        # The move decision uniforms of all refs are drawn at once
+        self.node_of_ref, delta, total_refs_moved = self.process_refs(np.random.random(self.num_refugees))
+
+        self.weights_arr += delta
         
         if config['new_friends_lower'] > 0 and config['new_friends_upper'] > 0:
             print("Adding friendships at camps...")
-            # Randomly create friendships between refs at same node
+            # Group refs by node once: refs_by_node[ref_start[n]:ref_start[n + 1]] are the refs at node n
+            refs_by_node = np.argsort(self.node_of_ref, kind='stable').astype(np.int32)
+            ref_start = np.concatenate([[0], np.cumsum(np.bincount(self.node_of_ref, minlength=len(self.nodes)))])
+
+            # Randomly create friendships between refs at same node. The new links are collected and
+            # appended to the friend edges once, rather than reallocating the edge arrays for every camp
             new_friendships = 0
-            for node in self.graph.nodes():
-                if (self.graph.nodes[node]['num_camps'] > 0) and (self.graph.nodes[node]['weight'] > 1):
-                    num_new_rels = random.randint(config['new_friends_lower'], config['new_friends_upper'])
-                    for x in range(num_new_rels):
-                        ref1 = random.choice(ref_nodes[node])
-                        ref2 = ref1
-                        while ref2 == ref1:
-                            ref2 = random.choice(ref_nodes[node])
-                        new_friendships += 1
-                        self.all_refugees[ref1].friend_list[ref2] = 1
-                        self.all_refugees[ref2].friend_list[ref1] = 1
+            new_src, new_dst = [self.friend_src], [self.friend_dst]
+            for n in np.flatnonzero((self.num_camps_arr > 0) & (self.weights_arr > 1)):
+                refs_at_node = refs_by_node[ref_start[n]:ref_start[n + 1]]
+                num_new_rels = random.randint(config['new_friends_lower'], config['new_friends_upper'])
+                # Draw all pairs at once. Offsetting the second ref by 1..n-1 guarantees ref2 != ref1
+                first = np.random.randint(0, len(refs_at_node), num_new_rels)
+                second = (first + np.random.randint(1, len(refs_at_node), num_new_rels)) % len(refs_at_node)
+                ref1, ref2 = refs_at_node[first], refs_at_node[second]
+                new_src += [ref1, ref2]
+                new_dst += [ref2, ref1]
+                new_friendships += num_new_rels
+            self.friend_src, self.friend_dst = np.concatenate(new_src), np.concatenate(new_dst)
+            self.update_social_links()
             print(f'Added {new_friendships} friendships at camps...')
 
         # print(self.graph.nodes)
@@ -335,24 +261,35 @@ class Sim(object):
         if (isinstance(config['seed_refs_per_node'], int) and config['seed_refs_per_node'] > 0) or (iterable(config['seed_refs_per_node']) and config['seed_refs_per_node'][0] > 0):
             print('Seeding network at border crossings...')
             new_ref_index = self.num_refugees
-           
+            seed_nodes = np.array([self.node_id[node] for node in config['seed_nodes']], dtype=np.int32)
+            seed_refs = []
+
             for node in config['seed_nodes']:
                 num_refs = random.randint(config['seed_refs_per_node'][0], config['seed_refs_per_node'][1]) if iterable(config['seed_refs_per_node']) else config['seed_refs_per_node']
                 self.num_refugees += num_refs
-                self.graph.nodes[node]['weight'] += num_refs
-                self.all_refugees.extend([Ref(node, self.num_refugees) for x in range(0, num_refs)])
+                self.weights_arr[self.node_id[node]] += num_refs
+                seed_refs.append(num_refs)
+            # Extend the ref arrays once for all seed nodes
+            self.node_of_ref = np.concatenate([self.node_of_ref, np.repeat(seed_nodes, seed_refs)])
             print('Creating social links')
             # create social links
-            if isinstance(config['num_friends'], int):
-                for index, ref in enumerate(self.all_refugees[new_ref_index:]):
-                    ref.create_defined_social_links(index, self)
-            else:
-                for index, ref in enumerate(self.all_refugees[new_ref_index:]):
-                    ref.create_random_social_links(index, self)
+            self.create_social_links(new_ref_index)
+            self.update_social_links()
 
         return total_refs_moved
-                    
+
+    def sync_weights(self):
+        """
+        Write the node weights held in weights_arr back to the graph
+        """
+        nx.set_node_attributes(self.graph, dict(zip(self.nodes, self.weights_arr.tolist())), 'weight')
+
     def run(self, polys=None):
+        # numba launches its worker threads once and reuses them for every step of the run,
+        # so only the number of threads the kernel runs on is set here
+        numba.set_num_threads(min(self.num_processes, numba.config.NUMBA_NUM_THREADS))
+        print(f'Processing refs on {numba.get_num_threads()} threads...')
+
         avg_step_time = 0
         avg_refs_moved = 0
         for x in list(range(self.num_steps)):
@@ -361,6 +298,7 @@ class Sim(object):
             refs_moved = self.step()
 
             if config['write_step_shapefiles'] and not config['test'] and polys is not None:
+                self.sync_weights()
                 node_weights = nx.get_node_attributes(self.graph, 'weight')
                 # Write out to shapefile
                 polys['REFPOP'] = polys['NAME_2'].map(node_weights)
@@ -372,6 +310,8 @@ class Sim(object):
             print(f'Step Time: {step_time:2f}')
             print(f'Num refs moved: {refs_moved}')
 
+        self.sync_weights()
+
         avg_step_time /= self.num_steps
         avg_refs_moved /= self.num_steps
         print(f'Average step time: {avg_step_time:2f}')
@@ -427,25 +367,24 @@ def preprocess():
                                 crs='epsg:4326')
     # conflict.crs = 'epsg:4326'
     # Create new column in target shapefile for count of conflict events per district
-    polys["conflict"] = polys.apply(lambda row: sum(conflict.within(row.geometry)), axis=1)
+    polys["conflict"] = count_within(conflict, polys)
 
     # ** Add camps **
     # Read in refugee camp data (and re-project) from UNHCR Regional IM Working Group February 2019 (updated every 6 months)
     camps = gpd.read_file(os.path.join(config['data_dir'], 'tur_camps.shp'))
     # Create new column in target shapefile for refugee camps
-    polys["camp"] = polys.apply(lambda row: sum(camps.within(row.geometry)), axis=1)
+    polys["camp"] = count_within(camps, polys)
 
     ## Add location score
     # Calculate location score. Districts closest to specified location are scored highest.
-    polys['location'] = polys.apply(
-        lambda row: math.sqrt(
-            (row.geometry.centroid.x - config['anchor_location'][1]) ** 2 + (row.geometry.centroid.y - config['anchor_location'][0]) ** 2), axis=1)
-    max_distance = max(list(polys['location']))
-    polys['location'] = polys.apply(lambda row: 1 - (row.location / max_distance), axis=1)
+    centroids = polys.geometry.centroid
+    distance = np.sqrt((centroids.x.to_numpy() - config['anchor_location'][1]) ** 2 +
+                       (centroids.y.to_numpy() - config['anchor_location'][0]) ** 2)
+    polys['location'] = 1 - (distance / distance.max())
 
     ## Create centroids GPD
     points = polys.copy()
-    points['geometry'] = points['geometry'].centroid
+    points['geometry'] = centroids
 
     # Write points to new Shapefile
     points.to_file(os.path.join(config['data_dir'], 'preprocessed_data.shp'))
@@ -456,6 +395,14 @@ def preprocess():
     return polys, points, pop_by_province
 
 
+def count_within(points, polys):
+    """
+    Count the points that fall within each polygon, using one spatial join instead of a within test per polygon
+    """
+    joined = gpd.sjoin(points[['geometry']], polys[['geometry']], predicate='within')
+    return joined.groupby('index_right').size().reindex(polys.index, fill_value=0)
+
+
 def build_graph(data):
     # ***Network Creation using NetworkX***
     graph = nx.Graph()
@@ -463,9 +410,17 @@ def build_graph(data):
     if isinstance(data, str):
         data = gpd.read_file(data)
 
+    # ***Find Edges***
+    # All pairs of districts that share a border, from one spatial join. Pairs are kept in data order
+    # so nodes and edges are added to the graph in the same order as a touches test per district
+    geoms = data[['NAME_2', 'geometry']].reset_index(drop=True)
+    pairs = gpd.sjoin(geoms, geoms, predicate='touches').reset_index()
+    pairs = pairs.sort_values(['index', 'index_right'])
+    neighbors = pairs.groupby('index')['NAME_2_right'].agg(list)
+
     # ***Add Nodes to Graph***
     positions = {}
-    for index, row in data.iterrows():
+    for i, (index, row) in enumerate(data.iterrows()):
         node = row.NAME_2
         # Add the coordinates to the nodes so they can be displayed geospatially
         coords = row['geometry'].centroid
@@ -475,34 +430,164 @@ def build_graph(data):
 
         positions[node] = (coords.x, coords.y)
 
-        nx.set_node_attributes(graph, positions, 'position')
-
         # ***Add Edges to Graph***
-        neighbors = data[data.geometry.touches(row['geometry'])].NAME_2.tolist()
-        for n in neighbors:
+        for n in neighbors.get(i, []):
             edge = (row.NAME_2, n)
             edge = sorted(edge)
             graph.add_edge(edge[0], edge[1], weight=1)
 
+    nx.set_node_attributes(graph, positions, 'position')
+
     return graph
 
 
+@njit(cache=True)
+def count_at_node(n, ref, indptr, indices, node_of_ref):
+    """
+    Count the social links (kin or friends) of a ref that are currently at node n
+    """
+    count = 0
+    for i in range(indptr[ref], indptr[ref + 1]):
+        if node_of_ref[indices[i]] == n:
+            count += 1
+    return count
+
+
+@njit(cache=True)
+def node_desirability(n, ref, node_of_ref, node_score, kin_indptr, kin_indices, friend_indptr, friend_indices,
+                      kin_weight, friend_weight, max_kin, max_friends):
+    """
+    Desirability of node n for a ref: node score plus kin and friend attraction
+    """
+    kin_at_node = count_at_node(n, ref, kin_indptr, kin_indices, node_of_ref)
+    friends_at_node = count_at_node(n, ref, friend_indptr, friend_indices, node_of_ref)
+    return (max(kin_at_node, max_kin) * kin_weight) + \
+           (max(friends_at_node, max_friends) * friend_weight) + \
+           node_score[n]
+
+
+@njit(cache=True)
+def find_new_node(node, ref, node_of_ref, node_score, best_node, kin_indptr, kin_indices, friend_indptr,
+                  friend_indices, kin_weight, friend_weight, max_kin, max_friends):
+    """
+    Return the most desirable node for a ref: the node with a higher node score than its current node
+    that maximizes node score plus kin and friend attraction.
+
+    If kin_weight and friend_weight are both >= 0, kin and friends can only add to a node's desirability,
+    so of the nodes without any only best_node (the first node with the highest node score) can win. The
+    candidates are then best_node and the nodes the ref's kin and friends are at, which are touched directly
+    instead of scanning every node in the graph. With a negative weight every higher scoring node is scanned.
+    """
+    # initialize max node value to negative number
+    most_desirable_score = -99.0
+    most_desirable_neighbor = node
+
+    if kin_weight < 0 or friend_weight < 0:
+        for n in range(len(node_score)):
+            if node_score[n] > node_score[node]:
+                desirability = node_desirability(n, ref, node_of_ref, node_score,
+                                                 kin_indptr, kin_indices, friend_indptr, friend_indices,
+                                                 kin_weight, friend_weight, max_kin, max_friends)
+                if desirability > most_desirable_score:
+                    most_desirable_score = desirability
+                    most_desirable_neighbor = n
+        return most_desirable_neighbor
+
+    if node_score[best_node] > node_score[node]:
+        desirability = node_desirability(best_node, ref, node_of_ref, node_score,
+                                         kin_indptr, kin_indices, friend_indptr, friend_indices,
+                                         kin_weight, friend_weight, max_kin, max_friends)
+        if desirability > most_desirable_score:
+            most_desirable_score = desirability
+            most_desirable_neighbor = best_node
+
+    for indptr, indices in ((kin_indptr, kin_indices), (friend_indptr, friend_indices)):
+        for i in range(indptr[ref], indptr[ref + 1]):
+            n = node_of_ref[indices[i]]
+            if node_score[n] > node_score[node]:
+                desirability = node_desirability(n, ref, node_of_ref, node_score,
+                                                 kin_indptr, kin_indices, friend_indptr, friend_indices,
+                                                 kin_weight, friend_weight, max_kin, max_friends)
+
+                # Ties between accepted candidates go to the lowest node id, as in a scan over all nodes.
+                # The current node is never a candidate, so it marks that none has been accepted yet
+                if desirability > most_desirable_score or \
+                        (desirability == most_desirable_score and most_desirable_neighbor != node and
+                         n < most_desirable_neighbor):
+                    most_desirable_score = desirability
+                    most_desirable_neighbor = n
+
+    return most_desirable_neighbor
+
+
+@njit(parallel=True, cache=True)
+def process_refs_jit(node_of_ref, node_score, next_hop, kin_indptr, kin_indices, friend_indptr, friend_indices,
+                     rand_buf, num_conflicts, num_camps, camp_move_probability, other_move_probability,
+                     kin_weight, friend_weight, max_kin, max_friends):
+    """
+    Decide which refs move and move them to the next node in the direction of their most desirable node.
+    Returns the new node per ref and the number of refs moved
+    """
+    best_node = np.argmax(node_score)
+    new_nodes = np.empty(len(node_of_ref), dtype=np.int32)
+    refs_moved = 0
+    for x in prange(len(node_of_ref)):
+        node = node_of_ref[x]
+        if num_conflicts[node] > 0:
+            # Conflict zone
+            move = True
+        elif num_camps[node] > 0:
+            # At a camp
+            move = rand_buf[x] < camp_move_probability
+        else:
+            # Neither camp nor conflict
+            move = rand_buf[x] < other_move_probability
+
+        if move:
+            high_node = find_new_node(node, x, node_of_ref, node_score, best_node,
+                                      kin_indptr, kin_indices, friend_indptr, friend_indices,
+                                      kin_weight, friend_weight, max_kin, max_friends)
+            # the next node in the path in the direction of most desirable
+            new_nodes[x] = next_hop[node, high_node]
+            refs_moved += 1
+        else:
+            new_nodes[x] = node
+    return new_nodes, refs_moved
+
+
+def build_csr(src, dst, num_refs):
+    """
+    Pack social link edges src -> dst into compressed sparse row (indptr, indices) int32 arrays.
+    The links of ref r are indices[indptr[r]:indptr[r + 1]], in the order they were added
+    """
+    src = np.asarray(src, dtype=np.int32)
+    dst = np.asarray(dst, dtype=np.int32)
+    indptr = np.concatenate([[0], np.bincount(src, minlength=num_refs).cumsum()]).astype(np.int32)
+    indices = dst[np.argsort(src, kind='stable')]
+    return indptr, indices
+
+
 def draw(polys, graph):
     polys.plot(color='cadetblue', edgecolor='black')
     nx.draw(graph, node_size=25, node_color='darkblue', pos=nx.get_node_attributes(graph, 'position'))
     plt.show()
 
 
-def time_trial(graph, output_file='results.csv', num_steps=5, num_processes=[1], num_batches=[1]):
+def time_trial(graph, paths, output_file='results.csv', num_steps=5, num_processes=[1], num_batches=[1]):
     global sim
-    
+
+    # Compile (or load the cached) numba kernels once so the first trial is not charged for it
+    print('Compiling sim kernels...')
+    Sim(graph.copy(), paths, 1).step()
+
     with open(output_file, 'w+', newline='') as fp:
         writer = csv.writer(fp)
         writer.writerow(['STEPS', 'PROCESSES', 'BATCHES', 'TIME_(S)'])
         for n_process in num_processes:
             #             for n_batch in num_batches:
-            sim = Sim(graph, num_steps, n_process, n_process)
-            avg_step_time = sim.run()
+            # Every trial starts from the same graph; a sim writes its node weights back to its graph
+            sim = Sim(graph.copy(), paths, num_steps, n_process, n_process)
+            avg_step_time, avg_refs_moved = sim.run()
 
             writer.writerow([num_steps, n_process, n_process, avg_step_time])
             fp.flush()
@@ -533,8 +618,7 @@ def run_sim():
         num_breaks = 50
         refs = int(float(config['total_refs']) / num_breaks)
         refs_per_node = {key: 0 for key in graph.nodes()}
-        for x in range(0, num_breaks):
-            node = random.choice(list(graph.nodes()))
+        for node in random.choices(list(graph.nodes()), k=num_breaks):
             refs_per_node[node] += refs
 
         nx.set_node_attributes(graph, name='weight', values=refs_per_node)
@@ -564,10 +648,6 @@ def run_sim():
             print('Drawing graph...')
             draw(polys, graph)
 
-    if config['time_trial']:
-        time_trial(graph, num_steps=config['trial_steps'], num_processes=config['trial_processes'], num_batches=config['trial_chunks'])
-        sys.exit()
-
     # Remove isloates from graph - todo- change this to be connected to closest node
     graph.remove_nodes_from(list(nx.isolates(graph)))
         
@@ -580,6 +660,10 @@ def run_sim():
         
     s = time.time() - s
     print(f'Took {s:.2f} seconds to compute shortest paths.')
+
+    if config['time_trial']:
+        time_trial(graph, paths, num_steps=config['trial_steps'], num_processes=config['trial_processes'], num_batches=config['trial_chunks'])
+        sys.exit()
     
     # Run Sim
     print('Creating sim...')